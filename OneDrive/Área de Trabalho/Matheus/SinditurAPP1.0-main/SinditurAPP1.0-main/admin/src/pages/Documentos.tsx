@@ -105,11 +105,16 @@ export default function Documentos() {
         custom_fields: customFields
       })
       
-      // Download PDF
+      // Download PDF (raw bytes; the name comes from Content-Disposition)
+      const disposition = String(response.headers['content-disposition'] || '')
+      const encodedName = disposition.match(/filename\*=UTF-8''([^;]+)/)
+      const plainName = disposition.match(/filename="([^"]+)"/)
+      const url = URL.createObjectURL(response.data)
       const link = document.createElement('a')
-      link.href = `data:application/pdf;base64,${response.data.pdf_base64}`
-      link.download = response.data.filename
+      link.href = url
+      link.download = encodedName ? decodeURIComponent(encodedName[1]) : plainName ? plainName[1] : 'documento.pdf'
       link.click()
+      setTimeout(() => URL.revokeObjectURL(url), 1000)
       
       toast.success('PDF baixado!')
     } catch (error) {
@@ -100,7 +100,7 @@ export default function Equipe() {
         phone: doctor.phone || '',
         email: doctor.email || '',
         bio: doctor.bio || '',
-        photo_base64: doctor.photo_base64 || '',
+        photo_base64: '',
         available_days: doctor.available_days || []
       })
     } else {
@@ -141,8 +141,8 @@ export default function Equipe() {
       return
     }
 
-    // Validar foto obrigatória
-    if (!doctorFormData.photo_base64) {
+    // Validar foto obrigatória (ao editar, a foto atual é mantida se nenhuma nova for enviada)
+    if (!doctorFormData.photo_base64 && !editingDoctor?.photo_id) {
       toast.warning('A foto do doutor é obrigatória!')
       return
     }
@@ -277,8 +277,8 @@ export default function Equipe() {
               {doctors.map((doctor) => (
                 <div key={doctor.id} className="doctor-card">
                   <div className="doctor-photo">
-                    {doctor.photo_base64 ? (
-                      <img src={`data:image/jpeg;base64,${doctor.photo_base64}`} alt={doctor.name} />
+                    {doctor.photo_id ? (
+                      <img src={doctorsAPI.photoUrl(doctor)} alt={doctor.name} />
                     ) : (
                       <div className="no-photo">
                         <FiCamera />
@@ -383,6 +383,8 @@ export default function Equipe() {
               <div className="photo-preview">
                 {doctorFormData.photo_base64 ? (
                   <img src={`data:image/jpeg;base64,${doctorFormData.photo_base64}`} alt="Preview" />
+                ) : editingDoctor?.photo_id ? (
+                  <img src={doctorsAPI.photoUrl(editingDoctor)} alt="Preview" />
                 ) : (
                   <div className="photo-placeholder">
                     <FiCamera />
@@ -392,7 +394,7 @@ export default function Equipe() {
               </div>
               <div className="photo-upload-btn">
                 <label className="btn-primary">
-                  <FiCamera /> {doctorFormData.photo_base64 ? 'Alterar Foto' : 'Selecionar Foto *'}
+                  <FiCamera /> {doctorFormData.photo_base64 || editingDoctor?.photo_id ? 'Alterar Foto' : 'Selecionar Foto *'}
                   <input
                     type="file"
                     accept="image/*"
@@ -42,7 +42,8 @@ export const doctorsAPI = {
   getAll: () => api.get('/admin/doctors'),
   create: (data: any) => api.post('/admin/doctors', data),
   update: (id: string, data: any) => api.put(`/admin/doctors/${id}`, data),
-  delete: (id: string) => api.delete(`/admin/doctors/${id}`)
+  delete: (id: string) => api.delete(`/admin/doctors/${id}`),
+  photoUrl: (doctor: any) => `/api/doctors/${doctor.id}/photo?v=${doctor.photo_id}`
 }
 
 export const appointmentsAPI = {
@@ -74,7 +75,7 @@ export const documentsAPI = {
   getTemplates: () => api.get('/admin/document-templates'),
   updateTemplate: (type: string, content: string) => api.put(`/admin/document-templates/${type}`, { content }),
   generate: (data: any) => api.post('/admin/documents/generate', data),
-  generatePDF: (data: any) => api.post('/admin/documents/generate-pdf', data)
+  generatePDF: (data: any) => api.post('/admin/documents/generate-pdf', data, { responseType: 'blob' })
 }
 
 export default api
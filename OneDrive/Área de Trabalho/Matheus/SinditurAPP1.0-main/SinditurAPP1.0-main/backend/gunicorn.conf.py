@@ -0,0 +1,25 @@
+# Gunicorn settings for production:
+#   gunicorn -c gunicorn.conf.py
+#
+# Each worker runs its own uvicorn event loop (uvloop + httptools when installed).
+# Socket.IO keeps its rooms in memory per worker, so events only reach clients on
+# other workers through Redis: without REDIS_URL a single worker is used, and
+# asking for more is refused. With several workers the load balancer must also
+# use sticky sessions for the Socket.IO polling transport.
+import multiprocessing
+import os
+
+wsgi_app = "server:app"
+bind = os.environ.get("BIND", "0.0.0.0:8001")
+
+if os.environ.get("REDIS_URL"):
+    workers = int(os.environ.get("WEB_CONCURRENCY", 2 * multiprocessing.cpu_count() + 1))
+else:
+    workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    if workers > 1:
+        raise RuntimeError("WEB_CONCURRENCY > 1 requires REDIS_URL, otherwise Socket.IO events are lost between workers")
+
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 60))
+graceful_timeout = 30
+keepalive = 5
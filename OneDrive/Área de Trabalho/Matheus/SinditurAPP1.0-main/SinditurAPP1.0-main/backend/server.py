@@ -1,20 +1,26 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Response, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, status, Response, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, ORJSONResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from bson import Binary
 import os
+import asyncio
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
 from typing import List, Optional
 import uuid
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 import base64
+import unicodedata
+from urllib.parse import quote
 from io import BytesIO
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -22,14 +28,37 @@ from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image as RLImage
 from reportlab.lib.enums import TA_CENTER, TA_JUSTIFY, TA_LEFT
 import socketio
+from redis import asyncio as aioredis
 import json
+import hashlib
+import time
+import re
+import functools
+from cachetools import TTLCache
+
+# uvloop is optional (not available on Windows); fall back to the stdlib loop
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # MongoDB connection
+# Pool sized per worker process (see gunicorn.conf.py for the worker count);
+# zstd (zstandard is in the requirements) with zlib as the fallback
 mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', 50)),
+    minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 5)),
+    maxIdleTimeMS=60000,
+    serverSelectionTimeoutMS=3000,
+    compressors="zstd,zlib",
+    retryWrites=True
+)
 db = client[os.environ.get('DB_NAME', 'dental_clinic')]
 
 # JWT Settings
@@ -37,8 +66,31 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'dental-clinic-secret-key-2024')
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Validated tokens, keyed by SHA-256 of the raw token. Short TTL so that
+# changes to the user (e.g. active=False) still converge quickly.
+JWT_CACHE_TTL_SECONDS = 30
+_jwt_cache = TTLCache(maxsize=10000, ttl=JWT_CACHE_TTL_SECONDS)
+
+# Staff/patient documents keyed by (user_type, user_id), plus the lookups
+# currently in flight so concurrent requests share a single query; dropped
+# in every worker by invalidate_user (see invalidate_cache)
+USER_CACHE_TTL_SECONDS = 30
+_user_cache = TTLCache(maxsize=5000, ttl=USER_CACHE_TTL_SECONDS)
+_user_inflight = {}
+
+# Reference collections only change through admin CRUD, so their full
+# listings are kept in memory and dropped on every write (in every worker,
+# see invalidate_cache)
+REF_CACHE_TTL_SECONDS = 60
+_ref_cache = {"units": None, "services": None, "doctors": None}
+_ref_cache_at = {"units": 0.0, "services": 0.0, "doctors": 0.0}
+
+# Document template contents keyed by type, dropped by update_document_template
+# (in every worker, see invalidate_cache)
+_template_cache = TTLCache(maxsize=32, ttl=REF_CACHE_TTL_SECONDS)
+
+# Password hashing: new hashes use argon2, existing bcrypt hashes still verify
+pwd_context = CryptContext(schemes=["argon2", "bcrypt"], deprecated="auto", bcrypt__rounds=10)
 
 # Security
 security = HTTPBearer()
@@ -46,16 +98,25 @@ security = HTTPBearer()
 # Brazil timezone (UTC-3)
 BRT = timezone(timedelta(hours=-3))
 
+# PDF styles are immutable, so they are built once instead of per document
+PDF_STYLES = getSampleStyleSheet()
+PDF_TITLE_STYLE = ParagraphStyle('Title', parent=PDF_STYLES['Heading1'], alignment=TA_CENTER, fontSize=14, spaceAfter=20)
+PDF_BODY_STYLE = ParagraphStyle('Body', parent=PDF_STYLES['Normal'], alignment=TA_JUSTIFY, fontSize=12, leading=18, spaceAfter=12)
+PDF_SIGNATURE_STYLE = ParagraphStyle('Signature', parent=PDF_STYLES['Normal'], alignment=TA_CENTER, fontSize=12, spaceBefore=40)
+
 # ==================== SOCKET.IO SETUP ====================
+# With REDIS_URL set, emits are published through Redis so they reach clients on every worker
+REDIS_URL = os.environ.get('REDIS_URL')
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    client_manager=socketio.AsyncRedisManager(REDIS_URL) if REDIS_URL else None,
     cors_allowed_origins='*',
     logger=False,
     engineio_logger=False
 )
 
 # Create the main FastAPI app
-fastapi_app = FastAPI(title="Dental Clinic API")
+fastapi_app = FastAPI(title="Dental Clinic API", default_response_class=ORJSONResponse)
 
 # Create routers
 api_router = APIRouter(prefix="/api")
@@ -92,6 +153,8 @@ class UserResponse(BaseModel):
     company: Optional[str] = ""
     created_at: datetime
 
+USER_RESPONSE_PROJECTION = {"_id": 0, **{field: 1 for field in UserResponse.model_fields}}
+
 class PatientUpdate(BaseModel):
     name: Optional[str] = None
     phone: Optional[str] = None
@@ -130,6 +193,8 @@ class StaffResponse(BaseModel):
     active: bool
     created_at: datetime
 
+STAFF_RESPONSE_PROJECTION = {"_id": 0, **{field: 1 for field in StaffResponse.model_fields}}
+
 # Unit Models
 class UnitCreate(BaseModel):
     name: str
@@ -198,7 +263,7 @@ class Doctor(BaseModel):
     cro: Optional[str] = ""
     phone: Optional[str] = ""
     email: Optional[str] = ""
-    photo_base64: Optional[str] = None
+    photo_id: Optional[str] = None  # served by GET /api/doctors/{id}/photo
     bio: str
     available_days: List[str]
 
@@ -235,6 +300,8 @@ class AppointmentResponse(BaseModel):
     paid_value: Optional[float] = 0.0
     created_at: datetime
 
+APPOINTMENT_PROJECTION = {"_id": 0, **{field: 1 for field in AppointmentResponse.model_fields}}
+
 # Inventory Models
 class InventoryItemCreate(BaseModel):
     name: str
@@ -273,41 +340,73 @@ class TokenResponse(BaseModel):
 
 # ==================== HELPER FUNCTIONS ====================
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+# Hashing is CPU-bound, so it runs in a worker thread to keep the event loop free
+async def verify_password(plain_password, hashed_password):
+    return await asyncio.to_thread(pwd_context.verify, plain_password, hashed_password)
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await asyncio.to_thread(pwd_context.hash, password)
 
 def create_access_token(data: dict):
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
+    to_encode["exp"] = int(time.time()) + ACCESS_TOKEN_EXPIRE_MINUTES * 60
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+async def _fetch_user(user_type, user_id):
+    generation = _cache_generation
+    collection = db.staff if user_type == "staff" else db.users
+    user = await collection.find_one({"id": user_id}, {"_id": 0, "password": 0})
+    if user is not None:
+        user["user_type"] = user_type
+        # Not cached if the user was invalidated while the query ran
+        if generation == _cache_generation:
+            _user_cache[(user_type, user_id)] = user
+    return user
+
+async def get_user_by_id(user_type, user_id):
+    """Get a staff member or patient, served from cache when possible"""
+    key = (user_type, user_id)
+    user = _user_cache.get(key)
+    if user is not None:
+        return user
+    
+    task = _user_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_user(user_type, user_id))
+        _user_inflight[key] = task
+        # An invalidation may already have replaced this lookup with a newer one
+        task.add_done_callback(lambda done: _user_inflight.pop(key) if _user_inflight.get(key) is done else None)
+    # Shielded so one cancelled request does not cancel the shared lookup
+    return await asyncio.shield(task)
+
+async def invalidate_user(user_type, user_id):
+    """Drop a cached user after it was changed or removed"""
+    await invalidate_cache(f"user:{user_type}:{user_id}")
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    try:
-        token = credentials.credentials
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        user_id: str = payload.get("sub")
-        user_type: str = payload.get("type", "patient")
-        if user_id is None:
-            raise HTTPException(status_code=401, detail="Token inválido")
-    except JWTError:
-        raise HTTPException(status_code=401, detail="Token inválido")
-    
-    if user_type == "staff":
-        user = await db.staff.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="Usuário não encontrado")
-        user["user_type"] = "staff"
+    token = credentials.credentials
+    cache_key = hashlib.sha256(token.encode()).digest()
+    cached = _jwt_cache.get(cache_key)
+    if cached is not None and cached[0] > time.time():
+        _, user_type, user_id = cached
     else:
-        user = await db.users.find_one({"id": user_id})
-        if user is None:
-            raise HTTPException(status_code=401, detail="Usuário não encontrado")
-        user["user_type"] = "patient"
-    
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            user_id: str = payload.get("sub")
+            user_type: str = payload.get("type", "patient")
+            if user_id is None:
+                raise HTTPException(status_code=401, detail="Token inválido")
+        except JWTError:
+            raise HTTPException(status_code=401, detail="Token inválido")
+        
+        # Only successful verifications are cached, never past the token's own expiry
+        expires_at = min(payload["exp"], time.time() + JWT_CACHE_TTL_SECONDS)
+        _jwt_cache[cache_key] = (expires_at, user_type, user_id)
+    
+    user = await get_user_by_id("staff" if user_type == "staff" else "patient", user_id)
+    if user is None:
+        raise HTTPException(status_code=401, detail="Usuário não encontrado")
     return user
 
 async def get_staff_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -320,13 +419,288 @@ def get_brazil_now():
     """Get current time in Brazil (UTC-3)"""
     return datetime.now(BRT)
 
+_BR_DATE_RE = re.compile(r"^(\d{1,2})/(\d{1,2})/(\d{4})$")
+
+# Appointment dates repeat a lot and the results are immutable, so they are memoized
+@functools.lru_cache(maxsize=1024)
 def parse_br_date(date_str):
     """Parse DD/MM/YYYY to datetime"""
+    match = _BR_DATE_RE.match(date_str)
+    if not match:
+        return None
     try:
-        parts = date_str.split("/")
-        return datetime(int(parts[2]), int(parts[1]), int(parts[0]), tzinfo=BRT)
-    except Exception:
+        return datetime(int(match[3]), int(match[2]), int(match[1]), tzinfo=BRT)
+    except ValueError:
+        return None
+
+def parse_br_datetime(date_str, time_str):
+    """Parse DD/MM/YYYY and HH:MM to a Brazil-time datetime, or None if either is invalid"""
+    apt_date = parse_br_date(date_str or "")
+    if not apt_date:
+        return None
+    try:
+        hour, minute = time_str.split(":")
+        return apt_date.replace(hour=int(hour), minute=int(minute))
+    except (ValueError, AttributeError):
+        return None
+
+def br_date_parts(date_str):
+    """Year and month fields of a DD/MM/YYYY date, used by the indexed financial queries"""
+    apt_date = parse_br_date(date_str or "")
+    if not apt_date:
+        return {"date_year": None, "date_month": None}
+    return {"date_year": apt_date.year, "date_month": apt_date.month}
+
+async def fetch_all(cursor, batch_size=200):
+    """Read every document from a cursor, without the silent cap of to_list(n)"""
+    return await cursor.batch_size(batch_size).to_list(None)
+
+# Cleared the first time the server rejects transactions (standalone mongod)
+_transactions_supported = True
+
+async def run_in_transaction(callback):
+    """Run callback(session) in a transaction, or with session=None where transactions are unavailable"""
+    global _transactions_supported
+    if _transactions_supported:
+        try:
+            async with await client.start_session() as session:
+                return await session.with_transaction(callback)
+        except OperationFailure as e:
+            # IllegalOperation: transactions need a replica set or a sharded cluster
+            if e.code != 20:
+                raise
+            _transactions_supported = False
+            logger.warning("MongoDB transactions unavailable, writing without them")
+    return await callback(None)
+
+_appointment_list_adapter = TypeAdapter(List[AppointmentResponse])
+_user_list_adapter = TypeAdapter(List[UserResponse])
+
+def appointment_list(docs):
+    """Validate appointment documents in a single pass and dump them as JSON-ready dicts"""
+    return _appointment_list_adapter.dump_python(_appointment_list_adapter.validate_python(docs), mode="json")
+
+def user_list(docs):
+    """Validate patient documents in a single pass and dump them as JSON-ready dicts"""
+    return _user_list_adapter.dump_python(_user_list_adapter.validate_python(docs), mode="json")
+
+# Cache invalidations are published over Redis (when configured) so that
+# every worker drops the entry, not only the one that handled the write
+CACHE_INVALIDATION_CHANNEL = "cache-invalidation"
+_cache_redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+_process_id = uuid.uuid4().hex
+# Bumped on every invalidation; a cache fill that started before it is not stored
+_cache_generation = 0
+
+def drop_cached(key):
+    """Forget a cached entry ("units", "services", "doctors", "template:<type>" or "user:<type>:<id>") in this process"""
+    global _cache_generation
+    _cache_generation += 1
+    if key.startswith("template:"):
+        _template_cache.pop(key[len("template:"):], None)
+    elif key.startswith("user:"):
+        _, user_type, user_id = key.split(":", 2)
+        _user_cache.pop((user_type, user_id), None)
+        # Requests arriving from now on must not join a lookup that started before the change
+        _user_inflight.pop((user_type, user_id), None)
+    elif key in _ref_cache:
+        _ref_cache[key] = None
+
+def drop_all_cached():
+    """Forget every cached entry in this process"""
+    for name in _ref_cache:
+        drop_cached(name)
+    _template_cache.clear()
+    _user_cache.clear()
+    _user_inflight.clear()
+
+async def invalidate_cache(key):
+    """Drop a cached entry in this process and tell the other workers to drop it too"""
+    drop_cached(key)
+    if _cache_redis is not None:
+        try:
+            await _cache_redis.publish(CACHE_INVALIDATION_CHANNEL, f"{_process_id} {key}")
+        except Exception as e:
+            logger.error(f"Error publishing cache invalidation: {e}")
+
+async def listen_cache_invalidations():
+    """Apply the cache invalidations published by other workers, for the life of the process"""
+    while True:
+        try:
+            async with _cache_redis.pubsub() as pubsub:
+                await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+                # Invalidations published while not subscribed were missed
+                drop_all_cached()
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    sender, key = message["data"].decode().split(" ", 1)
+                    if sender != _process_id:
+                        drop_cached(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error listening for cache invalidations: {e}")
+        await asyncio.sleep(1)
+
+REFERENCE_MODELS = {"units": Unit, "services": Service, "doctors": Doctor}
+
+async def get_reference_list(name):
+    """Get all documents of a reference collection (units, services, doctors)"""
+    docs = _ref_cache[name]
+    if docs is not None and time.monotonic() - _ref_cache_at[name] < REF_CACHE_TTL_SECONDS:
+        return docs
+    generation = _cache_generation
+    # Validated once per cache fill, so list endpoints can return the dicts as-is
+    model = REFERENCE_MODELS[name]
+    docs = [model(**d).model_dump() for d in await fetch_all(db[name].find({}, {"_id": 0}))]
+    # A write during the query may not be in docs, so only cache when nothing was invalidated
+    if generation == _cache_generation:
+        _ref_cache[name] = docs
+        _ref_cache_at[name] = time.monotonic()
+    return docs
+
+async def get_reference(name, doc_id):
+    """Get one document of a reference collection by id from the cached list, or None"""
+    return next((d for d in await get_reference_list(name) if d["id"] == doc_id), None)
+
+async def invalidate_reference_list(name):
+    """Drop a cached reference collection after a write"""
+    await invalidate_cache(name)
+
+async def get_template_content(template_type):
+    """Get the content of a document template, or None if the type does not exist"""
+    content = _template_cache.get(template_type)
+    if content is None:
+        generation = _cache_generation
+        template = await db.document_templates.find_one({"type": template_type}, {"_id": 0, "content": 1})
+        if not template:
+            return None
+        content = template["content"]
+        if generation == _cache_generation:
+            _template_cache[template_type] = content
+    return content
+
+# Unique key of a financial_rollup document, also used for the rebuild's staging collection
+FINANCIAL_ROLLUP_INDEX = [("period", 1), ("key", 1), ("unit_id", 1)]
+
+def financial_rollup_keys(apt):
+    """Monthly and daily rollup keys of a completed appointment, or None if its date is invalid"""
+    apt_date = parse_br_date(apt.get("date", ""))
+    if not apt_date:
         return None
+    unit_id = apt.get("unit_id") or ""
+    return [
+        {"period": "month", "key": f"{apt_date.year}-{apt_date.month:02d}", "unit_id": unit_id},
+        {"period": "day", "key": apt["date"], "unit_id": unit_id},
+    ]
+
+async def update_financial_rollup(before, after, session=None):
+    """Move an appointment's paid value in or out of the rollups as it enters or leaves 'concluido'
+
+    Run it in the same transaction as the appointment write, see run_in_transaction.
+    """
+    operations = []
+    for apt, sign in ((before, -1), (after, 1)):
+        if not apt or apt.get("status") != "concluido":
+            continue
+        keys = financial_rollup_keys(apt)
+        if not keys:
+            continue
+        paid = apt.get("paid_value") or 0
+        for key in keys:
+            operations.append(UpdateOne(key, {
+                "$inc": {"total_revenue": sign * paid, "total_appointments": sign},
+                "$set": {"unit_name": apt.get("unit_name") or "Sem unidade"}
+            }, upsert=True))
+    if operations:
+        await db.financial_rollup.bulk_write(operations, ordered=False, session=session)
+
+# Matches document template placeholders such as {NOME_PACIENTE}
+_PLACEHOLDER_RE = re.compile(r"\{([A-Z_]+)\}")
+
+@functools.lru_cache(maxsize=64)
+def compile_document_template(content):
+    """Split template content into alternating literal text and placeholder names"""
+    return tuple(_PLACEHOLDER_RE.split(content))
+
+def render_document(content, replacements):
+    """Fill the placeholders of a template in a single pass; unknown ones are kept"""
+    parts = compile_document_template(content)
+    rendered = []
+    for i, part in enumerate(parts):
+        if i % 2 == 0:
+            rendered.append(part)
+        elif part in replacements:
+            rendered.append(str(replacements[part]))
+        else:
+            rendered.append("{" + part + "}")
+    return "".join(rendered)
+
+MESES_PT = ("", "Janeiro", "Fevereiro", "Março", "Abril", "Maio", "Junho",
+            "Julho", "Agosto", "Setembro", "Outubro", "Novembro", "Dezembro")
+
+def document_replacements(patient, doctor, unit, custom_fields, now):
+    """Values for the template placeholders of a generated document"""
+    today = now.strftime("%d/%m/%Y")
+    return {
+        "NOME_PACIENTE": patient["name"],
+        "CPF_PACIENTE": patient["cpf"],
+        "NOME_DOUTOR": doctor["name"],
+        "CRO_DOUTOR": doctor.get("cro", ""),
+        "DATA": today,
+        "DATA_EXTENSO": f"{now.day:02d} de {MESES_PT[now.month]} de {now.year}",
+        "CIDADE": "Manaus - AM",
+        "NOME_CLINICA": "Odonto Sinditur",
+        "ENDERECO_CLINICA": unit["address"] if unit else "",
+        "DIAS_AFASTAMENTO": str(custom_fields.get("dias_afastamento", "1")),
+        "DATA_INICIO": custom_fields.get("data_inicio", today),
+        "DATA_FIM": custom_fields.get("data_fim", ""),
+        "PROCEDIMENTOS": custom_fields.get("procedimentos", ""),
+        "PROCEDIMENTO": custom_fields.get("procedimento", ""),
+        "MEDICAMENTOS": custom_fields.get("medicamentos", ""),
+        "OBSERVACOES": custom_fields.get("observacoes", ""),
+    }
+
+def build_document_pdf(content):
+    """Render document text to PDF bytes (CPU-bound, run it off the event loop)"""
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm, leftMargin=2*cm, rightMargin=2*cm)
+    
+    story = []
+    
+    # Header
+    story.append(Paragraph("ODONTO SINDITUR", PDF_TITLE_STYLE))
+    story.append(Spacer(1, 20))
+    
+    # Content
+    lines = content.split('\n')
+    for line in lines:
+        if line.strip():
+            if line.startswith('_'):
+                story.append(Paragraph(line, PDF_SIGNATURE_STYLE))
+            else:
+                story.append(Paragraph(line, PDF_BODY_STYLE))
+        else:
+            story.append(Spacer(1, 12))
+    
+    doc.build(story)
+    return buffer.getvalue()
+
+def detect_image_mime(raw):
+    """Guess the image type from its leading bytes (uploads are mostly JPEG)"""
+    if raw.startswith(b"\x89PNG"):
+        return "image/png"
+    if raw[:4] == b"RIFF" and raw[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+async def save_doctor_photo(photo_base64):
+    """Store an uploaded base64 photo as raw bytes and return its id"""
+    raw = base64.b64decode(photo_base64.split(",")[-1], validate=True)
+    photo_id = str(uuid.uuid4())
+    await db.doctor_photos.insert_one({"_id": photo_id, "data": Binary(raw), "mime": detect_image_mime(raw)})
+    return photo_id
 
 # ==================== SOCKET.IO EVENTS ====================
 
@@ -352,6 +726,16 @@ async def join_patient(sid, data):
         await sio.enter_room(sid, f'patient_{user_id}')
         logger.info(f"Patient joined: {sid} -> room patient_{user_id}")
 
+# Strong references to in-flight background emits; the event loop only keeps weak ones
+_background_tasks = set()
+
+def fire_and_forget(coro):
+    """Schedule a coroutine without awaiting it (errors are logged by the emit helpers)"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 async def emit_to_admin(event, data):
     """Emit event to all admin panel clients"""
     try:
@@ -435,6 +819,71 @@ CRO: {CRO_DOUTOR}
 {ENDERECO_CLINICA}"""
 }
 
+# Appointment statuses that occupy a doctor's time slot
+ACTIVE_APPOINTMENT_STATUSES = ["agendado", "concluido"]
+
+async def ensure_indexes():
+    """Ensure the indexes used by login, registration, booking and the admin listings exist"""
+    indexes = [
+        (db.users, "cpf", {"unique": True}),
+        (db.users, "id", {"unique": True}),
+        (db.users, "name", {}),
+        (db.staff, "email", {"unique": True}),
+        (db.staff, "id", {"unique": True}),
+        (db.appointments, "id", {"unique": True}),
+        (db.appointments, [("user_id", 1), ("created_at", -1)], {}),
+        (db.appointments, [("status", 1), ("date", 1)], {}),
+        (db.appointments, [("status", 1), ("date_year", 1), ("date_month", 1), ("unit_id", 1)], {}),
+        (db.appointments, [("unit_id", 1), ("status", 1)], {}),
+        (db.appointments, [("user_id", 1), ("status", 1), ("scheduled_at", 1)], {}),
+        (db.inventory, "id", {"unique": True}),
+        # Movements are always listed newest first, with at most one equality filter
+        (db.inventory_movements, [("created_at", -1)], {}),
+        (db.inventory_movements, [("item_id", 1), ("created_at", -1)], {}),
+        (db.inventory_movements, [("type", 1), ("created_at", -1)], {}),
+        (db.inventory_movements, [("doctor_id", 1), ("created_at", -1)], {}),
+        (db.document_templates, "type", {"unique": True}),
+        (db.financial_rollup, FINANCIAL_ROLLUP_INDEX, {"unique": True}),
+        (db.appointments, [("doctor_id", 1), ("date", 1)], {}),
+    ]
+    for collection, keys, options in indexes:
+        try:
+            await collection.create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Error creating index on {collection.name}: {e}")
+    
+    # create_appointment relies on this index alone to reject double booking, so it is
+    # required; partial indexes do not support $ne, so list the statuses that hold a slot
+    try:
+        await db.appointments.create_index([("doctor_id", 1), ("date", 1), ("time", 1)], unique=True,
+            partialFilterExpression={"status": {"$in": ACTIVE_APPOINTMENT_STATUSES}})
+    except OperationFailure as e:
+        # Usually legacy appointments sharing a slot, which have to be rescheduled or cancelled first
+        raise RuntimeError(f"Cannot create the appointment slot index, refusing to start without double booking protection: {e}") from e
+
+# Seeding and migrations check before they write, so workers run them one at a time;
+# a lock left behind by a crashed worker is taken over once it expires
+STARTUP_LOCK_TTL_SECONDS = 300
+
+async def acquire_startup_lock(owner):
+    """Wait until this process holds the startup lock"""
+    while True:
+        now = datetime.utcnow()
+        try:
+            await db.locks.update_one(
+                {"_id": "startup", "expires_at": {"$lt": now}},
+                {"$set": {"owner": owner, "expires_at": now + timedelta(seconds=STARTUP_LOCK_TTL_SECONDS)}},
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # Held by another worker: the upsert tried to insert a second "startup" lock
+            await asyncio.sleep(0.5)
+
+async def release_startup_lock(owner):
+    """Release the startup lock if this process still holds it"""
+    await db.locks.delete_one({"_id": "startup", "owner": owner})
+
 async def seed_data():
     """Seed initial data"""
     
@@ -452,7 +901,6 @@ async def seed_data():
         {"id": "unit-1", "name": "Unidade Sinditur - Flores", "address": "Rua das Flores, 123 - Flores", "phone": "(92) 3333-1111"},
         {"id": "unit-2", "name": "Unidade Centro", "address": "Av. Central, 456 - Centro", "phone": "(92) 3333-2222"}
     ]
-    await db.units.insert_many(units)
     
     # Services with prices
     services = [
@@ -464,49 +912,114 @@ async def seed_data():
         {"id": "service-6", "name": "Canal", "description": "Tratamento de canal dentário", "duration_minutes": 90, "price": 600.00},
         {"id": "service-7", "name": "Consulta Avaliação", "description": "Consulta inicial de avaliação", "duration_minutes": 30, "price": 100.00}
     ]
-    await db.services.insert_many(services)
     
     # Doctors with CRO
     doctors = [
-        {"id": "doctor-1", "name": "Dr. Carlos Silva", "specialty": "Clínico Geral", "unit_id": "unit-1", "cro": "AM-12345", "phone": "(92) 99999-1111", "email": "carlos@odonto.com", "photo_base64": None, "bio": "10 anos de experiência em odontologia geral", "available_days": ["Segunda", "Terça", "Quarta", "Quinta", "Sexta"]},
-        {"id": "doctor-2", "name": "Dra. Ana Santos", "specialty": "Ortodontista", "unit_id": "unit-1", "cro": "AM-12346", "phone": "(92) 99999-2222", "email": "ana@odonto.com", "photo_base64": None, "bio": "Especialista em aparelhos ortodônticos", "available_days": ["Segunda", "Quarta", "Sexta"]},
-        {"id": "doctor-3", "name": "Dr. Pedro Oliveira", "specialty": "Endodontista", "unit_id": "unit-2", "cro": "AM-12347", "phone": "(92) 99999-3333", "email": "pedro@odonto.com", "photo_base64": None, "bio": "Especialista em tratamento de canal", "available_days": ["Terça", "Quinta", "Sexta"]},
-        {"id": "doctor-4", "name": "Dra. Maria Costa", "specialty": "Clínico Geral", "unit_id": "unit-2", "cro": "AM-12348", "phone": "(92) 99999-4444", "email": "maria@odonto.com", "photo_base64": None, "bio": "8 anos de experiência em procedimentos estéticos", "available_days": ["Segunda", "Terça", "Quarta", "Quinta"]}
+        {"id": "doctor-1", "name": "Dr. Carlos Silva", "specialty": "Clínico Geral", "unit_id": "unit-1", "cro": "AM-12345", "phone": "(92) 99999-1111", "email": "carlos@odonto.com", "photo_id": None, "bio": "10 anos de experiência em odontologia geral", "available_days": ["Segunda", "Terça", "Quarta", "Quinta", "Sexta"]},
+        {"id": "doctor-2", "name": "Dra. Ana Santos", "specialty": "Ortodontista", "unit_id": "unit-1", "cro": "AM-12346", "phone": "(92) 99999-2222", "email": "ana@odonto.com", "photo_id": None, "bio": "Especialista em aparelhos ortodônticos", "available_days": ["Segunda", "Quarta", "Sexta"]},
+        {"id": "doctor-3", "name": "Dr. Pedro Oliveira", "specialty": "Endodontista", "unit_id": "unit-2", "cro": "AM-12347", "phone": "(92) 99999-3333", "email": "pedro@odonto.com", "photo_id": None, "bio": "Especialista em tratamento de canal", "available_days": ["Terça", "Quinta", "Sexta"]},
+        {"id": "doctor-4", "name": "Dra. Maria Costa", "specialty": "Clínico Geral", "unit_id": "unit-2", "cro": "AM-12348", "phone": "(92) 99999-4444", "email": "maria@odonto.com", "photo_id": None, "bio": "8 anos de experiência em procedimentos estéticos", "available_days": ["Segunda", "Terça", "Quarta", "Quinta"]}
     ]
-    await db.doctors.insert_many(doctors)
+    await asyncio.gather(
+        db.units.insert_many(units),
+        db.services.insert_many(services),
+        db.doctors.insert_many(doctors)
+    )
     
     await ensure_document_templates()
     await ensure_admin_user()
     
     logger.info("Data seeded successfully")
 
+async def migrate_doctor_photos():
+    """Move photos stored inline as base64 on doctors into doctor_photos"""
+    async for doctor in db.doctors.find({"photo_base64": {"$exists": True}}, {"_id": 0, "id": 1, "photo_base64": 1}):
+        photo_id = None
+        if doctor.get("photo_base64"):
+            try:
+                photo_id = await save_doctor_photo(doctor["photo_base64"])
+            except ValueError as e:
+                logger.error(f"Invalid photo for doctor {doctor['id']}: {e}")
+        await db.doctors.update_one({"id": doctor["id"]}, {"$set": {"photo_id": photo_id}, "$unset": {"photo_base64": ""}})
+
+async def backfill_appointment_dates():
+    """Store scheduled_at, date_year and date_month on appointments created before those fields existed"""
+    operations = []
+    missing = {"$or": [{"scheduled_at": {"$exists": False}}, {"date_year": {"$exists": False}}]}
+    async for apt in db.appointments.find(missing, {"_id": 0, "id": 1, "date": 1, "time": 1}):
+        # Unparseable dates get None, so they are not revisited on every startup
+        scheduled_at = parse_br_datetime(apt.get("date"), apt.get("time"))
+        operations.append(UpdateOne({"id": apt["id"]}, {"$set": {"scheduled_at": scheduled_at, **br_date_parts(apt.get("date"))}}))
+        if len(operations) == 500:
+            await db.appointments.bulk_write(operations, ordered=False)
+            operations = []
+    if operations:
+        await db.appointments.bulk_write(operations, ordered=False)
+
+async def rebuild_financial_rollup():
+    """Recompute financial_rollup from the completed appointments, replacing what is stored"""
+    async def rebuild(session):
+        totals = {}
+        async for apt in db.appointments.find({"status": "concluido"}, {"_id": 0, "date": 1, "unit_id": 1, "unit_name": 1, "paid_value": 1}, session=session):
+            for key in financial_rollup_keys(apt) or []:
+                row = totals.setdefault(tuple(key.values()), {**key, "unit_name": apt.get("unit_name") or "Sem unidade", "total_revenue": 0, "total_appointments": 0})
+                row["total_revenue"] += apt.get("paid_value") or 0
+                row["total_appointments"] += 1
+        rows = list(totals.values())
+        if session is not None:
+            # In a transaction, an appointment update committed meanwhile makes this retry
+            await db.financial_rollup.delete_many({}, session=session)
+            if rows:
+                await db.financial_rollup.insert_many(rows, session=session)
+            return
+        
+        # Without transactions, build the new rollup aside and swap it in with a single
+        # rename, so summaries never read an empty or half-built collection
+        staging = db[f"financial_rollup_rebuild_{uuid.uuid4().hex}"]
+        try:
+            await staging.create_index(FINANCIAL_ROLLUP_INDEX, unique=True)
+            if rows:
+                await staging.insert_many(rows)
+            await staging.rename("financial_rollup", dropTarget=True)
+        except Exception:
+            await staging.drop()
+            raise
+    
+    await run_in_transaction(rebuild)
+
 async def ensure_document_templates():
     """Ensure document templates exist"""
-    for template_type, content in DEFAULT_DOCUMENT_TEMPLATES.items():
-        existing = await db.document_templates.find_one({"type": template_type})
-        if not existing:
-            await db.document_templates.insert_one({
-                "id": str(uuid.uuid4()),
-                "type": template_type,
-                "content": content,
-                "updated_at": datetime.utcnow()
-            })
+    # One batched upsert; $setOnInsert leaves templates edited by admins untouched
+    operations = [
+        UpdateOne({"type": template_type}, {"$setOnInsert": {
+            "id": str(uuid.uuid4()),
+            "content": content,
+            "updated_at": datetime.utcnow()
+        }}, upsert=True)
+        for template_type, content in DEFAULT_DOCUMENT_TEMPLATES.items()
+    ]
+    await db.document_templates.bulk_write(operations, ordered=False)
 
 async def ensure_admin_user():
     """Ensure admin user exists"""
     admin = await db.staff.find_one({"email": "admin@odonto.com"})
-    if not admin:
+    if admin:
+        return
+    try:
         await db.staff.insert_one({
             "id": str(uuid.uuid4()),
             "name": "Administrador",
             "email": "admin@odonto.com",
-            "password": get_password_hash("admin123"),
+            "password": await get_password_hash("admin123"),
             "role": "admin",
             "permissions": ["all"],
             "active": True,
             "created_at": datetime.utcnow()
         })
-        logger.info("Admin user created: admin@odonto.com / admin123")
+    except DuplicateKeyError:
+        # Created by another process in the meantime
+        return
+    logger.info("Admin user created: admin@odonto.com / admin123")
 
 # ==================== PATIENT AUTH ROUTES ====================
 
@@ -517,6 +1030,7 @@ async def register(user_data: UserRegister):
         raise HTTPException(status_code=400, detail="CPF já cadastrado")
     
     user_id = str(uuid.uuid4())
+    now = datetime.now(timezone.utc)
     user_dict = {
         "id": user_id,
         "name": user_data.name,
@@ -527,19 +1041,23 @@ async def register(user_data: UserRegister):
         "gender": "",
         "associate": "",
         "company": "",
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
-    await db.users.insert_one(user_dict)
+    # The unique cpf index settles concurrent registrations that both passed the check above
+    try:
+        await db.users.insert_one(user_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="CPF já cadastrado")
     
     access_token = create_access_token(data={"sub": user_id, "type": "patient"})
     
     # Emit real-time event to admin
-    await emit_to_admin('new_patient', {
+    fire_and_forget(emit_to_admin('new_patient', {
         "id": user_id,
         "name": user_data.name,
         "cpf": user_data.cpf,
-        "timestamp": datetime.utcnow().isoformat()
-    })
+        "timestamp": now.isoformat()
+    }))
     
     return {
         "access_token": access_token,
@@ -574,11 +1092,12 @@ async def login(credentials: UserLogin):
         "user": UserResponse(**user_resp)
     }
 
-@api_router.get("/auth/me")
+@api_router.get("/auth/me", response_model=None)
 async def get_me(current_user: dict = Depends(get_current_user)):
+    # current_user comes straight from the database, so skip re-validating it
     if current_user.get("user_type") == "staff":
-        return StaffResponse(**{k: current_user[k] for k in ["id", "name", "email", "role", "permissions", "active", "created_at"]})
-    return UserResponse(**{
+        return {k: current_user[k] for k in ["id", "name", "email", "role", "permissions", "active", "created_at"]}
+    return {
         "id": current_user["id"],
         "name": current_user["name"],
         "cpf": current_user["cpf"],
@@ -589,16 +1108,20 @@ async def get_me(current_user: dict = Depends(get_current_user)):
         "associate": current_user.get("associate", ""),
         "company": current_user.get("company", ""),
         "created_at": current_user["created_at"]
-    })
+    }
 
 # ==================== STAFF AUTH ROUTES ====================
 
 @admin_router.post("/auth/login")
 async def staff_login(credentials: StaffLogin):
     staff = await db.staff.find_one({"email": credentials.email})
-    if not staff or not verify_password(credentials.password, staff["password"]):
+    if not staff or not await verify_password(credentials.password, staff["password"]):
         raise HTTPException(status_code=401, detail="Email ou senha inválidos")
     
+    # Upgrade legacy bcrypt hashes now that we have the plain password
+    if pwd_context.needs_update(staff["password"]):
+        await db.staff.update_one({"id": staff["id"]}, {"$set": {"password": await get_password_hash(credentials.password)}})
+    
     if not staff.get("active", True):
         raise HTTPException(status_code=401, detail="Usuário inativo")
     
@@ -612,10 +1135,9 @@ async def staff_login(credentials: StaffLogin):
 
 # ==================== STAFF MANAGEMENT ROUTES ====================
 
-@admin_router.get("/staff")
+@admin_router.get("/staff", response_model=None)
 async def get_all_staff(current_user: dict = Depends(get_staff_user)):
-    staff_list = await db.staff.find().to_list(100)
-    return [StaffResponse(**{k: s[k] for k in ["id", "name", "email", "role", "permissions", "active", "created_at"]}) for s in staff_list]
+    return await fetch_all(db.staff.find({}, STAFF_RESPONSE_PROJECTION))
 
 @admin_router.post("/staff")
 async def create_staff(staff_data: StaffCreate, current_user: dict = Depends(get_staff_user)):
@@ -631,7 +1153,7 @@ async def create_staff(staff_data: StaffCreate, current_user: dict = Depends(get
         "id": staff_id,
         "name": staff_data.name,
         "email": staff_data.email,
-        "password": get_password_hash(staff_data.password),
+        "password": await get_password_hash(staff_data.password),
         "role": staff_data.role,
         "permissions": staff_data.permissions,
         "active": True,
@@ -646,14 +1168,15 @@ async def update_staff(staff_id: str, staff_data: StaffUpdate, current_user: dic
     if current_user.get("role") != "admin" and current_user.get("id") != staff_id:
         raise HTTPException(status_code=403, detail="Sem permissão")
     
-    update_dict = {k: v for k, v in staff_data.dict().items() if v is not None}
+    update_dict = staff_data.model_dump(exclude_none=True, exclude_unset=True)
     if "password" in update_dict:
-        update_dict["password"] = get_password_hash(update_dict["password"])
+        update_dict["password"] = await get_password_hash(update_dict["password"])
     
     if update_dict:
         await db.staff.update_one({"id": staff_id}, {"$set": update_dict})
+        await invalidate_user("staff", staff_id)
     
-    staff = await db.staff.find_one({"id": staff_id})
+    staff = await db.staff.find_one({"id": staff_id}, {"_id": 0, "password": 0})
     return StaffResponse(**{k: staff[k] for k in ["id", "name", "email", "role", "permissions", "active", "created_at"]})
 
 @admin_router.delete("/staff/{staff_id}")
@@ -662,99 +1185,138 @@ async def delete_staff(staff_id: str, current_user: dict = Depends(get_staff_use
         raise HTTPException(status_code=403, detail="Apenas administradores podem remover colaboradores")
     
     await db.staff.delete_one({"id": staff_id})
+    await invalidate_user("staff", staff_id)
     return {"message": "Colaborador removido"}
 
 # ==================== UNITS ROUTES ====================
 
-@api_router.get("/units")
+@api_router.get("/units", response_model=None)
 async def get_units():
-    units = await db.units.find().to_list(100)
-    return [Unit(**u) for u in units]
+    return await get_reference_list("units")
 
 @admin_router.post("/units")
 async def create_unit(unit_data: UnitCreate, current_user: dict = Depends(get_staff_user)):
     unit_id = str(uuid.uuid4())
-    unit_dict = {"id": unit_id, **unit_data.dict()}
+    unit_dict = {"id": unit_id, **unit_data.model_dump()}
     await db.units.insert_one(unit_dict)
+    await invalidate_reference_list("units")
     return Unit(**unit_dict)
 
 @admin_router.put("/units/{unit_id}")
 async def update_unit(unit_id: str, unit_data: UnitUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in unit_data.dict().items() if v is not None}
+    update_dict = unit_data.model_dump(exclude_none=True, exclude_unset=True)
     if update_dict:
         await db.units.update_one({"id": unit_id}, {"$set": update_dict})
+        await invalidate_reference_list("units")
     unit = await db.units.find_one({"id": unit_id})
     return Unit(**unit)
 
 @admin_router.delete("/units/{unit_id}")
 async def delete_unit(unit_id: str, current_user: dict = Depends(get_staff_user)):
     await db.units.delete_one({"id": unit_id})
+    await invalidate_reference_list("units")
     return {"message": "Unidade removida"}
 
 # ==================== SERVICES ROUTES ====================
 
-@api_router.get("/services")
+@api_router.get("/services", response_model=None)
 async def get_services():
-    services = await db.services.find().to_list(100)
+    services = await get_reference_list("services")
     # Return without price for patients
     return [{"id": s["id"], "name": s["name"], "description": s["description"], "duration_minutes": s["duration_minutes"]} for s in services]
 
-@admin_router.get("/services")
+@admin_router.get("/services", response_model=None)
 async def get_services_admin(current_user: dict = Depends(get_staff_user)):
-    services = await db.services.find().to_list(100)
-    return [Service(**s) for s in services]
+    return await get_reference_list("services")
 
 @admin_router.post("/services")
 async def create_service(service_data: ServiceCreate, current_user: dict = Depends(get_staff_user)):
     service_id = str(uuid.uuid4())
-    service_dict = {"id": service_id, **service_data.dict()}
+    service_dict = {"id": service_id, **service_data.model_dump()}
     await db.services.insert_one(service_dict)
+    await invalidate_reference_list("services")
     return Service(**service_dict)
 
 @admin_router.put("/services/{service_id}")
 async def update_service(service_id: str, service_data: ServiceUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in service_data.dict().items() if v is not None}
+    update_dict = service_data.model_dump(exclude_none=True, exclude_unset=True)
     if update_dict:
         await db.services.update_one({"id": service_id}, {"$set": update_dict})
+        await invalidate_reference_list("services")
     service = await db.services.find_one({"id": service_id})
     return Service(**service)
 
 @admin_router.delete("/services/{service_id}")
 async def delete_service(service_id: str, current_user: dict = Depends(get_staff_user)):
     await db.services.delete_one({"id": service_id})
+    await invalidate_reference_list("services")
     return {"message": "Serviço removido"}
 
 # ==================== DOCTORS ROUTES ====================
 
-@api_router.get("/doctors")
+@api_router.get("/doctors", response_model=None)
 async def get_doctors(unit_id: Optional[str] = None):
-    query = {"unit_id": unit_id} if unit_id else {}
-    doctors = await db.doctors.find(query).to_list(100)
-    return [Doctor(**d) for d in doctors]
-
-@admin_router.get("/doctors")
+    doctors = await get_reference_list("doctors")
+    if unit_id:
+        return [d for d in doctors if d["unit_id"] == unit_id]
+    return doctors
+
+@api_router.get("/doctors/{doctor_id}/photo")
+async def get_doctor_photo(doctor_id: str):
+    doctor = await db.doctors.find_one({"id": doctor_id}, {"_id": 0, "photo_id": 1})
+    photo = None
+    if doctor and doctor.get("photo_id"):
+        photo = await db.doctor_photos.find_one({"_id": doctor["photo_id"]})
+    if not photo:
+        raise HTTPException(status_code=404, detail="Foto não encontrada")
+    # A new upload gets a new photo_id, which clients pass as a cache buster
+    return Response(content=bytes(photo["data"]), media_type=photo["mime"], headers={"Cache-Control": "public, max-age=86400"})
+
+@admin_router.get("/doctors", response_model=None)
 async def get_doctors_admin(current_user: dict = Depends(get_staff_user)):
-    doctors = await db.doctors.find().to_list(100)
-    return [Doctor(**d) for d in doctors]
+    return await get_reference_list("doctors")
 
 @admin_router.post("/doctors")
 async def create_doctor(doctor_data: DoctorCreate, current_user: dict = Depends(get_staff_user)):
     doctor_id = str(uuid.uuid4())
-    doctor_dict = {"id": doctor_id, **doctor_data.dict()}
+    doctor_dict = {"id": doctor_id, **doctor_data.model_dump()}
+    photo_base64 = doctor_dict.pop("photo_base64", None)
+    try:
+        doctor_dict["photo_id"] = await save_doctor_photo(photo_base64) if photo_base64 else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Foto inválida")
     await db.doctors.insert_one(doctor_dict)
+    await invalidate_reference_list("doctors")
     return Doctor(**doctor_dict)
 
 @admin_router.put("/doctors/{doctor_id}")
 async def update_doctor(doctor_id: str, doctor_data: DoctorUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in doctor_data.dict().items() if v is not None}
+    update_dict = doctor_data.model_dump(exclude_none=True, exclude_unset=True)
+    
+    previous_photo_id = None
+    photo_base64 = update_dict.pop("photo_base64", None)
+    if photo_base64:
+        previous = await db.doctors.find_one({"id": doctor_id}, {"_id": 0, "photo_id": 1})
+        previous_photo_id = previous.get("photo_id") if previous else None
+        try:
+            update_dict["photo_id"] = await save_doctor_photo(photo_base64)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Foto inválida")
+    
     if update_dict:
         await db.doctors.update_one({"id": doctor_id}, {"$set": update_dict})
+        await invalidate_reference_list("doctors")
+    if previous_photo_id:
+        await db.doctor_photos.delete_one({"_id": previous_photo_id})
     doctor = await db.doctors.find_one({"id": doctor_id})
     return Doctor(**doctor)
 
 @admin_router.delete("/doctors/{doctor_id}")
 async def delete_doctor(doctor_id: str, current_user: dict = Depends(get_staff_user)):
-    await db.doctors.delete_one({"id": doctor_id})
+    doctor = await db.doctors.find_one_and_delete({"id": doctor_id}, {"_id": 0, "photo_id": 1})
+    await invalidate_reference_list("doctors")
+    if doctor and doctor.get("photo_id"):
+        await db.doctor_photos.delete_one({"_id": doctor["photo_id"]})
     return {"message": "Doutor removido"}
 
 # ==================== APPOINTMENTS ROUTES ====================
@@ -762,45 +1324,33 @@ async def delete_doctor(doctor_id: str, current_user: dict = Depends(get_staff_u
 @api_router.get("/appointments/booked-slots")
 async def get_booked_slots(doctor_id: str, date: str):
     """Get booked time slots for a doctor on a specific date"""
-    appointments = await db.appointments.find({
+    appointments = await fetch_all(db.appointments.find({
         "doctor_id": doctor_id,
         "date": date,
-        "status": {"$ne": "cancelado"}
-    }).to_list(100)
+        # Same statuses as the unique slot index, so a slot shown as free can be booked
+        "status": {"$in": ACTIVE_APPOINTMENT_STATUSES}
+    }, {"_id": 0, "time": 1}))
     
     booked_times = [apt["time"] for apt in appointments]
     return {"booked_times": booked_times, "date": date, "doctor_id": doctor_id}
 
 @api_router.post("/appointments")
 async def create_appointment(appointment: AppointmentCreate, current_user: dict = Depends(get_current_user)):
-    unit = await db.units.find_one({"id": appointment.unit_id})
-    service = await db.services.find_one({"id": appointment.service_id})
-    doctor = await db.doctors.find_one({"id": appointment.doctor_id})
+    unit, service, doctor = await asyncio.gather(
+        db.units.find_one({"id": appointment.unit_id}, {"_id": 0, "name": 1}),
+        db.services.find_one({"id": appointment.service_id}, {"_id": 0, "name": 1, "price": 1}),
+        db.doctors.find_one({"id": appointment.doctor_id}, {"_id": 0, "name": 1})
+    )
     
     if not unit or not service or not doctor:
         raise HTTPException(status_code=400, detail="Dados inválidos")
     
     # Server-side validation: Check for past date/time (Brazil UTC-3)
-    now_brazil = get_brazil_now()
-    apt_date = parse_br_date(appointment.date)
-    if apt_date:
-        try:
-            hour, minute = appointment.time.split(":")
-            apt_datetime = apt_date.replace(hour=int(hour), minute=int(minute))
-            if apt_datetime < now_brazil:
-                raise HTTPException(status_code=400, detail="Não é possível agendar em horários passados")
-        except ValueError:
-            pass
-    
-    # Server-side validation: Check for double booking
-    existing = await db.appointments.find_one({
-        "doctor_id": appointment.doctor_id,
-        "date": appointment.date,
-        "time": appointment.time,
-        "status": {"$ne": "cancelado"}
-    })
-    if existing:
-        raise HTTPException(status_code=400, detail="Este horário já está ocupado para o profissional selecionado")
+    now = datetime.now(timezone.utc)
+    now_brazil = now.astimezone(BRT)
+    scheduled_at = parse_br_datetime(appointment.date, appointment.time)
+    if scheduled_at and scheduled_at < now_brazil:
+        raise HTTPException(status_code=400, detail="Não é possível agendar em horários passados")
     
     appointment_id = str(uuid.uuid4())
     appointment_dict = {
@@ -817,15 +1367,21 @@ async def create_appointment(appointment: AppointmentCreate, current_user: dict
         "doctor_name": doctor["name"],
         "date": appointment.date,
         "time": appointment.time,
+        "scheduled_at": scheduled_at,
+        **br_date_parts(appointment.date),
         "status": "agendado",
         "notes": appointment.notes or "",
         "paid_value": 0,
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
-    await db.appointments.insert_one(appointment_dict)
+    # Server-side validation: double booking is rejected by the unique slot index
+    try:
+        await db.appointments.insert_one(appointment_dict)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Este horário já está ocupado para o profissional selecionado")
     
     # Emit real-time event to admin
-    await emit_to_admin('new_appointment', {
+    fire_and_forget(emit_to_admin('new_appointment', {
         "id": appointment_id,
         "patient_name": current_user.get("name", ""),
         "doctor_name": doctor["name"],
@@ -833,45 +1389,54 @@ async def create_appointment(appointment: AppointmentCreate, current_user: dict
         "service_name": service["name"],
         "date": appointment.date,
         "time": appointment.time,
-        "timestamp": datetime.utcnow().isoformat()
-    })
+        "timestamp": now.isoformat()
+    }))
     
     return AppointmentResponse(**appointment_dict)
 
-@api_router.get("/appointments")
+@api_router.get("/appointments", response_model=None)
 async def get_appointments(current_user: dict = Depends(get_current_user)):
-    appointments = await db.appointments.find({"user_id": current_user["id"]}).sort("created_at", -1).to_list(100)
-    return [AppointmentResponse(**apt) for apt in appointments]
+    appointments = await db.appointments.find({"user_id": current_user["id"]}, APPOINTMENT_PROJECTION).sort("created_at", -1).to_list(100)
+    return appointment_list(appointments)
 
 @api_router.delete("/appointments/{appointment_id}")
 async def cancel_appointment(appointment_id: str, current_user: dict = Depends(get_current_user)):
-    result = await db.appointments.update_one(
-        {"id": appointment_id, "user_id": current_user["id"]},
-        {"$set": {"status": "cancelado"}}
-    )
-    if result.modified_count == 0:
+    async def cancel(session):
+        # The appointment and its rollup change together, or not at all
+        previous = await db.appointments.find_one_and_update(
+            {"id": appointment_id, "user_id": current_user["id"], "status": {"$ne": "cancelado"}},
+            {"$set": {"status": "cancelado"}},
+            return_document=ReturnDocument.BEFORE,
+            session=session
+        )
+        if previous is not None:
+            await update_financial_rollup(previous, None, session)
+        return previous
+    
+    previous = await run_in_transaction(cancel)
+    if previous is None:
         raise HTTPException(status_code=404, detail="Agendamento não encontrado")
     
-    # Emit to admin
-    apt = await db.appointments.find_one({"id": appointment_id})
-    if apt:
-        await emit_to_admin('appointment_cancelled', {
-            "id": appointment_id,
-            "patient_name": apt.get("user_name", ""),
-            "date": apt.get("date", ""),
-            "time": apt.get("time", ""),
-            "timestamp": datetime.utcnow().isoformat()
-        })
+    # Emit to admin; only the status changed, so the pre-image has everything else
+    fire_and_forget(emit_to_admin('appointment_cancelled', {
+        "id": appointment_id,
+        "patient_name": previous.get("user_name", ""),
+        "date": previous.get("date", ""),
+        "time": previous.get("time", ""),
+        "timestamp": datetime.utcnow().isoformat()
+    }))
     
     return {"message": "Agendamento cancelado"}
 
 # Admin appointments
-@admin_router.get("/appointments")
+@admin_router.get("/appointments", response_model=None)
 async def get_all_appointments(
     status: Optional[str] = None,
     date: Optional[str] = None,
     doctor_id: Optional[str] = None,
     unit_id: Optional[str] = None,
+    limit: int = Query(500, ge=1, le=500),
+    offset: int = Query(0, ge=0),
     current_user: dict = Depends(get_staff_user)
 ):
     query = {}
@@ -884,12 +1449,12 @@ async def get_all_appointments(
     if unit_id:
         query["unit_id"] = unit_id
     
-    appointments = await db.appointments.find(query).sort("date", -1).to_list(500)
-    return [AppointmentResponse(**apt) for apt in appointments]
+    appointments = await db.appointments.find(query, APPOINTMENT_PROJECTION).sort("date", -1).skip(offset).limit(limit).to_list(limit)
+    return appointment_list(appointments)
 
 @admin_router.put("/appointments/{appointment_id}")
 async def update_appointment(appointment_id: str, data: AppointmentUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in data.dict().items() if v is not None}
+    update_dict = data.model_dump(exclude_none=True, exclude_unset=True)
     
     if "status" in update_dict and update_dict["status"] == "concluido":
         # Get appointment to add to financial
@@ -900,25 +1465,42 @@ async def update_appointment(appointment_id: str, data: AppointmentUpdate, curre
             update_dict["completed_at"] = datetime.utcnow()
     
     if update_dict:
-        await db.appointments.update_one({"id": appointment_id}, {"$set": update_dict})
-    
-    apt = await db.appointments.find_one({"id": appointment_id})
+        async def apply_update(session):
+            # The pre-image feeds the financial rollup; the new state is the pre-image plus the $set
+            previous = await db.appointments.find_one_and_update(
+                {"id": appointment_id}, {"$set": update_dict}, projection={"_id": 0},
+                return_document=ReturnDocument.BEFORE, session=session
+            )
+            if not previous:
+                return None
+            apt = {**previous, **update_dict}
+            await update_financial_rollup(previous, apt, session)
+            return apt
+        
+        # Reactivating an appointment whose slot was booked again hits the unique slot index
+        try:
+            apt = await run_in_transaction(apply_update)
+        except DuplicateKeyError:
+            raise HTTPException(status_code=400, detail="Este horário já está ocupado para o profissional selecionado")
+    else:
+        apt = await db.appointments.find_one({"id": appointment_id}, {"_id": 0})
+    if not apt:
+        raise HTTPException(status_code=404, detail="Agendamento não encontrado")
     
     # Emit status change to admin and patient
-    if apt:
-        await emit_to_admin('appointment_updated', {
-            "id": appointment_id,
-            "status": apt.get("status"),
-            "patient_name": apt.get("user_name", ""),
-            "timestamp": datetime.utcnow().isoformat()
-        })
-        # Notify patient
-        await emit_to_patient(apt.get("user_id"), 'appointment_status_changed', {
-            "id": appointment_id,
-            "status": apt.get("status"),
-            "date": apt.get("date", ""),
-            "time": apt.get("time", ""),
-        })
+    fire_and_forget(emit_to_admin('appointment_updated', {
+        "id": appointment_id,
+        "status": apt.get("status"),
+        "patient_name": apt.get("user_name", ""),
+        "timestamp": datetime.utcnow().isoformat()
+    }))
+    # Notify patient
+    fire_and_forget(emit_to_patient(apt.get("user_id"), 'appointment_status_changed', {
+        "id": appointment_id,
+        "status": apt.get("status"),
+        "date": apt.get("date", ""),
+        "time": apt.get("time", ""),
+    }))
     
     return AppointmentResponse(**apt)
 
@@ -932,33 +1514,26 @@ async def get_upcoming_reminders(current_user: dict = Depends(get_current_user))
     
     appointments = await db.appointments.find({
         "user_id": current_user["id"],
-        "status": "agendado"
-    }).to_list(100)
-    
-    reminders = []
-    for apt in appointments:
-        apt_date = parse_br_date(apt.get("date", ""))
-        if apt_date:
-            try:
-                hour, minute = apt.get("time", "00:00").split(":")
-                apt_datetime = apt_date.replace(hour=int(hour), minute=int(minute))
-                if now_brazil < apt_datetime <= tomorrow:
-                    reminders.append({
-                        "id": apt["id"],
-                        "date": apt["date"],
-                        "time": apt["time"],
-                        "doctor_name": apt.get("doctor_name", ""),
-                        "service_name": apt.get("service_name", ""),
-                        "unit_name": apt.get("unit_name", ""),
-                    })
-            except (ValueError, AttributeError):
-                pass
+        "status": "agendado",
+        "scheduled_at": {"$gt": now_brazil, "$lte": tomorrow}
+    }, {"_id": 0, "id": 1, "date": 1, "time": 1, "doctor_name": 1, "service_name": 1, "unit_name": 1}).sort("scheduled_at", 1).to_list(100)
+    
+    reminders = [{
+        "id": apt["id"],
+        "date": apt["date"],
+        "time": apt["time"],
+        "doctor_name": apt.get("doctor_name", ""),
+        "service_name": apt.get("service_name", ""),
+        "unit_name": apt.get("unit_name", ""),
+    } for apt in appointments]
     
     return {"reminders": reminders}
 
 # ==================== FINANCIAL ROUTES ====================
 
-@admin_router.get("/financial/summary")
+FINANCIAL_ROLLUP_PROJECTION = {"_id": 0, "unit_id": 1, "unit_name": 1, "total_revenue": 1, "total_appointments": 1}
+
+@admin_router.get("/financial/summary", response_model=None)
 async def get_financial_summary(
     month: Optional[int] = None,
     year: Optional[int] = None,
@@ -969,78 +1544,75 @@ async def get_financial_summary(
     target_month = month or now.month
     target_year = year or now.year
     
-    # Get completed appointments
-    query = {"status": "concluido"}
+    # Equality match on (status, date_year, date_month, unit_id) so the compound index serves it
+    query = {
+        "status": "concluido",
+        "date_year": target_year,
+        "date_month": target_month
+    }
     if unit_id:
         query["unit_id"] = unit_id
     
-    appointments = await db.appointments.find(query).to_list(1000)
-    
-    # Filter by month/year based on date string (DD/MM/YYYY)
-    monthly_total = 0
-    monthly_appointments = []
-    
-    # Per-clinic breakdown
-    clinic_totals = {}
+    # Totals come from the rollup kept up to date by update_appointment
+    rollup_query = {"period": "month", "key": f"{target_year}-{target_month:02d}", "total_appointments": {"$gt": 0}}
+    if unit_id:
+        rollup_query["unit_id"] = unit_id
     
-    for apt in appointments:
-        try:
-            date_parts = apt["date"].split("/")
-            if len(date_parts) == 3:
-                apt_month = int(date_parts[1])
-                apt_year = int(date_parts[2])
-                if apt_month == target_month and apt_year == target_year:
-                    paid = apt.get("paid_value", 0)
-                    monthly_total += paid
-                    monthly_appointments.append(apt)
-                    
-                    # Per-clinic
-                    clinic_name = apt.get("unit_name", "Sem unidade")
-                    clinic_id = apt.get("unit_id", "")
-                    if clinic_id not in clinic_totals:
-                        clinic_totals[clinic_id] = {
-                            "unit_id": clinic_id,
-                            "unit_name": clinic_name,
-                            "total_revenue": 0,
-                            "total_appointments": 0
-                        }
-                    clinic_totals[clinic_id]["total_revenue"] += paid
-                    clinic_totals[clinic_id]["total_appointments"] += 1
-        except Exception:
-            pass
+    clinic_totals, monthly_appointments = await asyncio.gather(
+        fetch_all(db.financial_rollup.find(rollup_query, FINANCIAL_ROLLUP_PROJECTION).sort("unit_name", 1)),
+        fetch_all(db.appointments.find(query, APPOINTMENT_PROJECTION))
+    )
     
-    avg_ticket = monthly_total / len(monthly_appointments) if monthly_appointments else 0
+    monthly_total = sum(c["total_revenue"] for c in clinic_totals)
+    total_appointments = sum(c["total_appointments"] for c in clinic_totals)
+    avg_ticket = monthly_total / total_appointments if total_appointments else 0
     
     return {
         "month": target_month,
         "year": target_year,
         "total_revenue": monthly_total,
-        "total_appointments": len(monthly_appointments),
+        "total_appointments": total_appointments,
         "average_ticket": avg_ticket,
-        "clinic_breakdown": list(clinic_totals.values()),
-        "appointments": [AppointmentResponse(**a) for a in monthly_appointments]
+        "clinic_breakdown": clinic_totals,
+        "appointments": appointment_list(monthly_appointments)
     }
 
-@admin_router.get("/financial/daily")
+@admin_router.post("/financial/rebuild")
+async def rebuild_financial_summary(current_user: dict = Depends(get_staff_user)):
+    """Recompute the financial rollups from the appointments, e.g. after a manual data fix"""
+    if current_user.get("role") != "admin":
+        raise HTTPException(status_code=403, detail="Apenas administradores podem recalcular o financeiro")
+    await rebuild_financial_rollup()
+    return {"message": "Financeiro recalculado"}
+
+@admin_router.get("/financial/daily", response_model=None)
 async def get_daily_financial(date: str, current_user: dict = Depends(get_staff_user)):
-    appointments = await db.appointments.find({
-        "date": date,
-        "status": "concluido"
-    }).to_list(100)
+    rollups, appointments = await asyncio.gather(
+        fetch_all(db.financial_rollup.find({"period": "day", "key": date}, FINANCIAL_ROLLUP_PROJECTION)),
+        fetch_all(db.appointments.find({
+            "date": date,
+            "status": "concluido"
+        }, APPOINTMENT_PROJECTION))
+    )
     
-    total = sum(apt.get("paid_value", 0) for apt in appointments)
+    total = sum(r["total_revenue"] for r in rollups)
     
     return {
         "date": date,
         "total_revenue": total,
-        "appointments": [AppointmentResponse(**a) for a in appointments]
+        "appointments": appointment_list(appointments)
     }
 
 # ==================== INVENTORY ROUTES ====================
 
 @admin_router.get("/inventory")
-async def get_inventory(current_user: dict = Depends(get_staff_user)):
-    items = await db.inventory.find().to_list(500)
+async def get_inventory(
+    limit: int = Query(500, ge=1, le=500),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_staff_user)
+):
+    # Sorted by _id (insertion order) so that pages are stable
+    items = await db.inventory.find({}, {"_id": 0}).sort("_id", 1).skip(offset).limit(limit).to_list(limit)
     return items
 
 @admin_router.post("/inventory")
@@ -1048,10 +1620,12 @@ async def create_inventory_item(item_data: InventoryItemCreate, current_user: di
     item_id = str(uuid.uuid4())
     item_dict = {
         "id": item_id,
-        **item_data.dict(),
+        **item_data.model_dump(),
         "created_at": datetime.utcnow()
     }
     await db.inventory.insert_one(item_dict)
+    # insert_one adds the ObjectId to the dict; it is not part of the response
+    item_dict.pop("_id")
     
     # Log movement
     await db.inventory_movements.insert_one({
@@ -1071,48 +1645,63 @@ async def create_inventory_item(item_data: InventoryItemCreate, current_user: di
 
 @admin_router.put("/inventory/{item_id}")
 async def update_inventory_item(item_id: str, item_data: InventoryItemUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in item_data.dict().items() if v is not None}
+    update_dict = item_data.model_dump(exclude_none=True, exclude_unset=True)
     if update_dict:
-        await db.inventory.update_one({"id": item_id}, {"$set": update_dict})
-    item = await db.inventory.find_one({"id": item_id})
+        item = await db.inventory.find_one_and_update(
+            {"id": item_id}, {"$set": update_dict}, projection={"_id": 0}, return_document=ReturnDocument.AFTER
+        )
+    else:
+        item = await db.inventory.find_one({"id": item_id}, {"_id": 0})
+    if not item:
+        raise HTTPException(status_code=404, detail="Item não encontrado")
     return item
 
 @admin_router.post("/inventory/movement")
 async def add_inventory_movement(movement: InventoryMovement, current_user: dict = Depends(get_staff_user)):
-    item = await db.inventory.find_one({"id": movement.item_id})
-    if not item:
-        raise HTTPException(status_code=404, detail="Item não encontrado")
-    
-    doctor_name = ""
-    if movement.doctor_id:
-        doctor = await db.doctors.find_one({"id": movement.doctor_id})
-        doctor_name = doctor["name"] if doctor else ""
-    
-    # Update quantity
-    new_quantity = item["quantity"]
-    if movement.type == "entrada":
-        new_quantity += movement.quantity
-    elif movement.type == "saida":
-        if item["quantity"] < movement.quantity:
-            raise HTTPException(status_code=400, detail="Quantidade insuficiente em estoque")
-        new_quantity -= movement.quantity
-    
-    await db.inventory.update_one({"id": movement.item_id}, {"$set": {"quantity": new_quantity}})
-    
-    # Log movement
-    movement_dict = {
-        "id": str(uuid.uuid4()),
-        "item_id": movement.item_id,
-        "item_name": item["name"],
-        "type": movement.type,
-        "quantity": movement.quantity,
-        "doctor_id": movement.doctor_id,
-        "doctor_name": doctor_name,
-        "notes": movement.notes,
-        "created_at": datetime.utcnow(),
-        "created_by": current_user.get("name", "")
-    }
-    await db.inventory_movements.insert_one(movement_dict)
+    doctor = await get_reference("doctors", movement.doctor_id) if movement.doctor_id else None
+    doctor_name = doctor["name"] if doctor else ""
+    
+    async def apply_movement(session):
+        # Single atomic update; a saida only matches while there is enough stock
+        if movement.type == "entrada":
+            item = await db.inventory.find_one_and_update(
+                {"id": movement.item_id},
+                {"$inc": {"quantity": movement.quantity}},
+                projection={"_id": 0, "name": 1},
+                session=session
+            )
+        elif movement.type == "saida":
+            item = await db.inventory.find_one_and_update(
+                {"id": movement.item_id, "quantity": {"$gte": movement.quantity}},
+                {"$inc": {"quantity": -movement.quantity}},
+                projection={"_id": 0, "name": 1},
+                session=session
+            )
+            if not item and await db.inventory.count_documents({"id": movement.item_id}, limit=1, session=session):
+                raise HTTPException(status_code=400, detail="Quantidade insuficiente em estoque")
+        else:
+            item = await db.inventory.find_one({"id": movement.item_id}, {"_id": 0, "name": 1}, session=session)
+        if not item:
+            raise HTTPException(status_code=404, detail="Item não encontrado")
+        
+        # Log movement in the same transaction as the stock change
+        movement_dict = {
+            "id": str(uuid.uuid4()),
+            "item_id": movement.item_id,
+            "item_name": item["name"],
+            "type": movement.type,
+            "quantity": movement.quantity,
+            "doctor_id": movement.doctor_id,
+            "doctor_name": doctor_name,
+            "notes": movement.notes,
+            "created_at": datetime.utcnow(),
+            "created_by": current_user.get("name", "")
+        }
+        await db.inventory_movements.insert_one(movement_dict, session=session)
+        movement_dict.pop("_id")
+        return movement_dict
+    
+    movement_dict = await run_in_transaction(apply_movement)
     
     return movement_dict
 
@@ -1131,155 +1720,114 @@ async def get_inventory_movements(
     if doctor_id:
         query["doctor_id"] = doctor_id
     
-    movements = await db.inventory_movements.find(query).sort("created_at", -1).to_list(500)
+    movements = await db.inventory_movements.find(query, {"_id": 0}).sort("created_at", -1).to_list(500)
     return movements
 
 # ==================== PATIENTS ROUTES ====================
 
-@admin_router.get("/patients")
-async def get_all_patients(current_user: dict = Depends(get_staff_user)):
-    patients = await db.users.find().sort("name", 1).to_list(1000)
-    return [UserResponse(**{
-        "id": p["id"],
-        "name": p["name"],
-        "cpf": p["cpf"],
-        "birth_date": p["birth_date"],
-        "phone": p.get("phone", ""),
-        "address": p.get("address", ""),
-        "gender": p.get("gender", ""),
-        "associate": p.get("associate", ""),
-        "company": p.get("company", ""),
-        "created_at": p["created_at"]
-    }) for p in patients]
-
-@admin_router.get("/patients/{patient_id}")
+@admin_router.get("/patients", response_model=None)
+async def get_all_patients(
+    limit: int = Query(1000, ge=1, le=1000),
+    offset: int = Query(0, ge=0),
+    current_user: dict = Depends(get_staff_user)
+):
+    patients = await db.users.find({}, USER_RESPONSE_PROJECTION).sort("name", 1).skip(offset).limit(limit).to_list(limit)
+    return user_list(patients)
+
+@admin_router.get("/patients/{patient_id}", response_model=None)
 async def get_patient(patient_id: str, current_user: dict = Depends(get_staff_user)):
-    patient = await db.users.find_one({"id": patient_id})
-    if not patient:
+    # Finished, cancelled, past or unparseable (null scheduled_at) appointments are history
+    is_upcoming = {"$and": [
+        {"$not": [{"$in": ["$$this.status", ["concluido", "cancelado"]]}]},
+        {"$gte": ["$$this.scheduled_at", "$$NOW"]}
+    ]}
+    
+    patients = await db.users.aggregate([
+        {"$match": {"id": patient_id}},
+        {"$lookup": {
+            "from": "appointments",
+            "let": {"patient_id": "$id"},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$user_id", "$$patient_id"]}}},
+                {"$sort": {"created_at": -1}},
+                {"$limit": 100},
+                {"$project": {**APPOINTMENT_PROJECTION, "scheduled_at": 1}}
+            ],
+            "as": "appointments"
+        }},
+        {"$project": {
+            **USER_RESPONSE_PROJECTION,
+            "history": {"$filter": {"input": "$appointments", "cond": {"$not": [is_upcoming]}}},
+            "upcoming": {"$filter": {"input": "$appointments", "cond": is_upcoming}}
+        }}
+    ]).to_list(1)
+    if not patients:
         raise HTTPException(status_code=404, detail="Paciente não encontrado")
     
-    # Get patient appointments
-    appointments = await db.appointments.find({"user_id": patient_id}).sort("created_at", -1).to_list(100)
-    
-    # Separate into history and upcoming
-    now_brazil = get_brazil_now()
-    history = []
-    upcoming = []
-    
-    for apt in appointments:
-        apt_resp = AppointmentResponse(**apt)
-        apt_date = parse_br_date(apt.get("date", ""))
-        if apt_date:
-            try:
-                hour, minute = apt.get("time", "00:00").split(":")
-                apt_datetime = apt_date.replace(hour=int(hour), minute=int(minute))
-                if apt_datetime < now_brazil or apt.get("status") in ["concluido", "cancelado"]:
-                    history.append(apt_resp)
-                else:
-                    upcoming.append(apt_resp)
-            except (ValueError, AttributeError):
-                history.append(apt_resp)
-        else:
-            history.append(apt_resp)
-    
+    patient = patients[0]
+    history = patient.pop("history")
+    upcoming = patient.pop("upcoming")
     return {
-        "patient": UserResponse(**{
-            "id": patient["id"],
-            "name": patient["name"],
-            "cpf": patient["cpf"],
-            "birth_date": patient["birth_date"],
-            "phone": patient.get("phone", ""),
-            "address": patient.get("address", ""),
-            "gender": patient.get("gender", ""),
-            "associate": patient.get("associate", ""),
-            "company": patient.get("company", ""),
-            "created_at": patient["created_at"]
-        }),
-        "history": history,
-        "upcoming": upcoming,
-        "appointments": [AppointmentResponse(**a) for a in appointments]
+        "patient": user_list([patient])[0],
+        "history": appointment_list(history),
+        "upcoming": appointment_list(upcoming)
     }
 
 @admin_router.put("/patients/{patient_id}")
 async def update_patient(patient_id: str, data: PatientUpdate, current_user: dict = Depends(get_staff_user)):
-    update_dict = {k: v for k, v in data.dict().items() if v is not None}
+    update_dict = data.model_dump(exclude_none=True, exclude_unset=True)
     
     if not update_dict:
         raise HTTPException(status_code=400, detail="Nenhum dado para atualizar")
     
-    result = await db.users.update_one({"id": patient_id}, {"$set": update_dict})
-    if result.matched_count == 0:
+    patient = await db.users.find_one_and_update(
+        {"id": patient_id}, {"$set": update_dict}, projection=USER_RESPONSE_PROJECTION, return_document=ReturnDocument.AFTER
+    )
+    if not patient:
         raise HTTPException(status_code=404, detail="Paciente não encontrado")
+    await invalidate_user("patient", patient_id)
     
-    patient = await db.users.find_one({"id": patient_id})
-    return UserResponse(**{
-        "id": patient["id"],
-        "name": patient["name"],
-        "cpf": patient["cpf"],
-        "birth_date": patient["birth_date"],
-        "phone": patient.get("phone", ""),
-        "address": patient.get("address", ""),
-        "gender": patient.get("gender", ""),
-        "associate": patient.get("associate", ""),
-        "company": patient.get("company", ""),
-        "created_at": patient["created_at"]
-    })
+    return UserResponse(**patient)
 
 # ==================== DOCUMENT TEMPLATES ROUTES ====================
 
 @admin_router.get("/document-templates")
 async def get_document_templates(current_user: dict = Depends(get_staff_user)):
-    templates = await db.document_templates.find().to_list(10)
-    # Remove MongoDB _id field for JSON serialization
-    return [{k: v for k, v in t.items() if k != '_id'} for t in templates]
+    return await db.document_templates.find({}, {"_id": 0}).to_list(10)
 
 @admin_router.put("/document-templates/{template_type}")
 async def update_document_template(template_type: str, data: DocumentTemplateUpdate, current_user: dict = Depends(get_staff_user)):
-    await db.document_templates.update_one(
+    template = await db.document_templates.find_one_and_update(
         {"type": template_type},
-        {"$set": {"content": data.content, "updated_at": datetime.utcnow()}}
+        {"$set": {"content": data.content, "updated_at": datetime.utcnow()}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
     )
-    template = await db.document_templates.find_one({"type": template_type})
+    await invalidate_cache(f"template:{template_type}")
+    if not template:
+        raise HTTPException(status_code=404, detail="Template não encontrado")
     return template
 
 @admin_router.post("/documents/generate")
 async def generate_document(data: DocumentGenerate, current_user: dict = Depends(get_staff_user)):
-    template = await db.document_templates.find_one({"type": data.template_type})
-    if not template:
+    template_content, patient, doctor = await asyncio.gather(
+        get_template_content(data.template_type),
+        db.users.find_one({"id": data.patient_id}),
+        get_reference("doctors", data.doctor_id)
+    )
+    if template_content is None:
         raise HTTPException(status_code=404, detail="Template não encontrado")
     
-    patient = await db.users.find_one({"id": data.patient_id})
-    doctor = await db.doctors.find_one({"id": data.doctor_id})
-    unit = await db.units.find_one({"id": doctor["unit_id"]}) if doctor else None
+    unit = await get_reference("units", doctor["unit_id"]) if doctor else None
     
     if not patient or not doctor:
         raise HTTPException(status_code=404, detail="Paciente ou doutor não encontrado")
     
     # Replace placeholders
-    content = template["content"]
     now = datetime.now()
+    replacements = document_replacements(patient, doctor, unit, data.custom_fields, now)
     
-    replacements = {
-        "{NOME_PACIENTE}": patient["name"],
-        "{CPF_PACIENTE}": patient["cpf"],
-        "{NOME_DOUTOR}": doctor["name"],
-        "{CRO_DOUTOR}": doctor.get("cro", ""),
-        "{DATA}": now.strftime("%d/%m/%Y"),
-        "{DATA_EXTENSO}": now.strftime("%d de %B de %Y").replace("January", "Janeiro").replace("February", "Fevereiro").replace("March", "Março").replace("April", "Abril").replace("May", "Maio").replace("June", "Junho").replace("July", "Julho").replace("August", "Agosto").replace("September", "Setembro").replace("October", "Outubro").replace("November", "Novembro").replace("December", "Dezembro"),
-        "{CIDADE}": "Manaus - AM",
-        "{NOME_CLINICA}": "Odonto Sinditur",
-        "{ENDERECO_CLINICA}": unit["address"] if unit else "",
-        "{DIAS_AFASTAMENTO}": str(data.custom_fields.get("dias_afastamento", "1")),
-        "{DATA_INICIO}": data.custom_fields.get("data_inicio", now.strftime("%d/%m/%Y")),
-        "{DATA_FIM}": data.custom_fields.get("data_fim", ""),
-        "{PROCEDIMENTOS}": data.custom_fields.get("procedimentos", ""),
-        "{PROCEDIMENTO}": data.custom_fields.get("procedimento", ""),
-        "{MEDICAMENTOS}": data.custom_fields.get("medicamentos", ""),
-        "{OBSERVACOES}": data.custom_fields.get("observacoes", ""),
-    }
-    
-    for key, value in replacements.items():
-        content = content.replace(key, str(value))
+    content = render_document(template_content, replacements)
     
     return {
         "content": content,
@@ -1293,88 +1841,35 @@ async def generate_document(data: DocumentGenerate, current_user: dict = Depends
 @admin_router.post("/documents/generate-pdf")
 async def generate_document_pdf(data: DocumentGenerate, current_user: dict = Depends(get_staff_user)):
     # First generate the content
-    template = await db.document_templates.find_one({"type": data.template_type})
-    if not template:
+    template_content, patient, doctor = await asyncio.gather(
+        get_template_content(data.template_type),
+        db.users.find_one({"id": data.patient_id}),
+        get_reference("doctors", data.doctor_id)
+    )
+    if template_content is None:
         raise HTTPException(status_code=404, detail="Template não encontrado")
     
-    patient = await db.users.find_one({"id": data.patient_id})
-    doctor = await db.doctors.find_one({"id": data.doctor_id})
-    unit = await db.units.find_one({"id": doctor["unit_id"]}) if doctor else None
+    unit = await get_reference("units", doctor["unit_id"]) if doctor else None
     
     if not patient or not doctor:
         raise HTTPException(status_code=404, detail="Paciente ou doutor não encontrado")
     
-    content = template["content"]
     now = datetime.now()
+    replacements = document_replacements(patient, doctor, unit, data.custom_fields, now)
     
-    meses_pt = {
-        "January": "Janeiro", "February": "Fevereiro", "March": "Março",
-        "April": "Abril", "May": "Maio", "June": "Junho",
-        "July": "Julho", "August": "Agosto", "September": "Setembro",
-        "October": "Outubro", "November": "Novembro", "December": "Dezembro"
-    }
-    
-    data_extenso = now.strftime("%d de %B de %Y")
-    for en, pt in meses_pt.items():
-        data_extenso = data_extenso.replace(en, pt)
-    
-    replacements = {
-        "{NOME_PACIENTE}": patient["name"],
-        "{CPF_PACIENTE}": patient["cpf"],
-        "{NOME_DOUTOR}": doctor["name"],
-        "{CRO_DOUTOR}": doctor.get("cro", ""),
-        "{DATA}": now.strftime("%d/%m/%Y"),
-        "{DATA_EXTENSO}": data_extenso,
-        "{CIDADE}": "Manaus - AM",
-        "{NOME_CLINICA}": "Odonto Sinditur",
-        "{ENDERECO_CLINICA}": unit["address"] if unit else "",
-        "{DIAS_AFASTAMENTO}": str(data.custom_fields.get("dias_afastamento", "1")),
-        "{DATA_INICIO}": data.custom_fields.get("data_inicio", now.strftime("%d/%m/%Y")),
-        "{DATA_FIM}": data.custom_fields.get("data_fim", ""),
-        "{PROCEDIMENTOS}": data.custom_fields.get("procedimentos", ""),
-        "{PROCEDIMENTO}": data.custom_fields.get("procedimento", ""),
-        "{MEDICAMENTOS}": data.custom_fields.get("medicamentos", ""),
-        "{OBSERVACOES}": data.custom_fields.get("observacoes", ""),
-    }
+    content = render_document(template_content, replacements)
     
-    for key, value in replacements.items():
-        content = content.replace(key, str(value))
+    # Generate PDF in a worker thread so other requests keep being served
+    pdf_bytes = await asyncio.to_thread(build_document_pdf, content)
     
-    # Generate PDF
-    buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4, topMargin=2*cm, bottomMargin=2*cm, leftMargin=2*cm, rightMargin=2*cm)
-    
-    styles = getSampleStyleSheet()
-    title_style = ParagraphStyle('Title', parent=styles['Heading1'], alignment=TA_CENTER, fontSize=14, spaceAfter=20)
-    body_style = ParagraphStyle('Body', parent=styles['Normal'], alignment=TA_JUSTIFY, fontSize=12, leading=18, spaceAfter=12)
-    signature_style = ParagraphStyle('Signature', parent=styles['Normal'], alignment=TA_CENTER, fontSize=12, spaceBefore=40)
-    
-    story = []
-    
-    # Header
-    story.append(Paragraph("ODONTO SINDITUR", title_style))
-    story.append(Spacer(1, 20))
-    
-    # Content
-    lines = content.split('\n')
-    for line in lines:
-        if line.strip():
-            if line.startswith('_'):
-                story.append(Paragraph(line, signature_style))
-            else:
-                story.append(Paragraph(line, body_style))
-        else:
-            story.append(Spacer(1, 12))
-    
-    doc.build(story)
-    
-    pdf_bytes = buffer.getvalue()
-    pdf_base64 = base64.b64encode(pdf_bytes).decode()
-    
-    return {
-        "pdf_base64": pdf_base64,
-        "filename": f"{data.template_type}_{patient['name'].replace(' ', '_')}_{now.strftime('%Y%m%d')}.pdf"
-    }
+    filename = f"{data.template_type}_{patient['name'].replace(' ', '_')}_{now.strftime('%Y%m%d')}.pdf"
+    # Plain ASCII fallback for old clients, RFC 5987 filename* for accented patient names
+    ascii_filename = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode().replace('"', "")
+    return Response(
+        content=pdf_bytes,
+        media_type="application/pdf",
+        headers={"Content-Disposition": f"attachment; filename=\"{ascii_filename}\"; filename*=UTF-8''{quote(filename)}"}
+    )
 
 # ==================== ROOT ROUTES ====================
 
@@ -1396,14 +1891,31 @@ fastapi_app.add_middleware(
     allow_origins=["*"],
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Content-Disposition"],
 )
 
 @fastapi_app.on_event("startup")
 async def startup_event():
-    await seed_data()
+    if _cache_redis is not None:
+        fastapi_app.state.cache_listener = asyncio.create_task(listen_cache_invalidations())
+    await ensure_indexes()
+    # Every gunicorn worker runs this hook; the lock keeps the one-time work serialized
+    lock_owner = str(uuid.uuid4())
+    await acquire_startup_lock(lock_owner)
+    try:
+        await seed_data()
+        await migrate_doctor_photos()
+        await backfill_appointment_dates()
+        if await db.financial_rollup.estimated_document_count() == 0:
+            await rebuild_financial_rollup()
+    finally:
+        await release_startup_lock(lock_owner)
 
 @fastapi_app.on_event("shutdown")
 async def shutdown_db_client():
+    if _cache_redis is not None:
+        fastapi_app.state.cache_listener.cancel()
+        await _cache_redis.aclose()
     client.close()
 
 # Wrap FastAPI with Socket.IO - this is the ASGI app uvicorn will load
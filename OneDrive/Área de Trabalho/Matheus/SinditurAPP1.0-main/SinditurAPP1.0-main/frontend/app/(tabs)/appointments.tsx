@@ -52,7 +52,7 @@ interface Doctor {
   name: string;
   specialty: string;
   unit_id: string;
-  photo_base64: string | null;
+  photo_id: string | null;
   bio: string;
   available_days: string[];
 }
@@ -354,9 +354,9 @@ export default function AppointmentsScreen() {
             onPress={() => setSelectedDoctor(doctor)}
           >
             <View style={styles.doctorPhotoContainer}>
-              {doctor.photo_base64 ? (
+              {doctor.photo_id ? (
                 <Image
-                  source={{ uri: `data:image/jpeg;base64,${doctor.photo_base64}` }}
+                  source={{ uri: doctorsAPI.photoUrl(doctor) }}
                   style={styles.doctorPhoto}
                 />
               ) : (
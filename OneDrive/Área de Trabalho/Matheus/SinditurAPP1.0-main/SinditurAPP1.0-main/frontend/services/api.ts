@@ -48,6 +48,8 @@ export const doctorsAPI = {
   getAll: (unitId?: string) =>
     api.get('/doctors', { params: unitId ? { unit_id: unitId } : {} }),
   getById: (id: string) => api.get(`/doctors/${id}`),
+  photoUrl: (doctor: { id: string; photo_id: string | null }) =>
+    `${API_URL}/api/doctors/${doctor.id}/photo?v=${doctor.photo_id}`,
 };
 
 // Appointments API